@@ -9,20 +9,20 @@
     image to the middle image by computing an affine then
     a nonlinear transform (ANTS software from UPenn).
 (5) Smooth each motion-corrected image with a sigma=3 Gaussian kernel.
-(6) Save individual motion-corrected and smoothed+motion-corrected images,
-    as well as concatenated images from (4) and from (5),
-    as nifti files (.nii.gz) for use with fMRI brain imaging software.
+(6) Save concatenated images from (4) and from (5) as nifti files (.nii.gz)
+    for use with fMRI brain imaging software, and save individual ratio,
+    motion-corrected, and smoothed+motion-corrected images in one indexed
+    frame store file (.frames; see frame_store.py).
 
-Outputs: Nifti files for each table (for each bee).
+Outputs: Nifti and frame store files for each table (for each bee).
 
 Command: python <this file name> <data directory> <output directory>
 
 Example: python preprocess_beebrains.py data output
 
 Requirements:  
-* Python libraries:  nibabel, numpy, scipy
+* Python libraries:  nibabel, numpy, scipy, Pillow
 * ANTS registration software for motion correction
-* ImageMagick for converting images and creating montage movies
 
 (c) 2012  Arno Klein, under Apache License Version 2.0
           arno@binarybottle.com  .  www.binarybottle.com
@@ -34,11 +34,15 @@ import csv
 import nibabel as nib
 import numpy as np
 from scipy.ndimage.filters import gaussian_filter
+from run_tools import run_commands, report_failures, make_work_dir, remove_work_dir
+import render_montages
+from frame_store import FrameStore
+from pst_format import open_pst, check_geometry
 
-# Settings
-xdim = 130
-ydim = 172
-frames_per_run = 232
+# Settings (None = detect from each table's .pst files)
+xdim = None
+ydim = None
+frames_per_run = None  # (None = from the file size, taking 232 if several geometries fit)
 #frame_stim1_on = '72'
 #frame_stim1_off = '84'
 #frame_stim2_on = '92'
@@ -57,99 +61,114 @@ save_nonlinear = 1
 # Save for visualizing results:
 save_montages = 0
 save_movie = 0
+# Number of external tool commands to run at once (0 = number of CPUs):
+n_jobs = 0
+# Directory for motion correction work files
+# (None = tmpfs if it has room, else the system temporary directory):
+work_dir_root = None
 
 # Command-line arguments
 args = sys.argv[1:]
 if len(args)<2:
-    print "\n\t Please provide the names of two directories: one containing .lst table files, another to save output."
-    print "\t Example: python " + sys.argv[0] + " data output"
+    print("\n\t Please provide the names of two directories: one containing .lst table files, another to save output.")
+    print("\t Example: python " + sys.argv[0] + " data output")
     sys.exit()
 
 # Loop through table files
 in_path = str(args[0])
 out_path = str(args[1])
 try:
-    os.system('mkdir ' + out_path)
-except IOError:
-    print "Cannot make " + out_path + " directory."
+    if not os.path.exists(out_path):
+        os.mkdir(out_path)
+except OSError:
+    print("Cannot make " + out_path + " directory.")
 try:
     table_files = glob(os.path.join(in_path,"*.lst"))
 except IOError:
-    print "Cannot make sense of provided path."
+    print("Cannot make sense of provided path.")
 for itable_file in table_files:
     table_file = str(itable_file)
     if os.path.exists(table_file):
         print('Table file:  ' + table_file)
         output_stem = os.path.join(out_path, table_file.split('/')[-1])
         output_path_images = output_stem + '_images'
+        output_frames = output_stem + '_images.frames'
 
-        # Load table and count how many rows are to be included (analysis = 2)
+        # Load table, open the .pst files in the rows to be included (analysis = 2),
+        # and check that their image geometries agree
         spamReader = csv.reader(open(table_file, 'r'), delimiter="\t")
-        count_rows = 0
-        for row in spamReader:
-            if row[-1] == '2':
-                count_rows += 1
+        pst_rows = []
+        try:
+            for row in spamReader:
+                if row[-1] == '2':
+                    file_lambda1 = os.path.join(in_path, row[3].replace('\\','/')) + '.pst'
+                    file_lambda2 = os.path.join(in_path, row[18].replace('\\','/')) + '.pst'
+                    pst1 = open_pst(file_lambda1, xdim, ydim, frames_per_run)
+                    pst2 = open_pst(file_lambda2, xdim, ydim, frames_per_run)
+                    check_geometry([pst1, pst2])
+                    pst_rows.append((row, pst1, pst2))
+            if not pst_rows:
+                print('No rows to include in ' + table_file + '.')
+                continue
+            image_xdim, image_ydim, _ = check_geometry([x[1] for x in pst_rows], n_frames=False)
+        except (ValueError, OSError) as error:
+            print('Skipping ' + table_file + ':  ' + str(error))
+            continue
+        print('Images:  {0} x {1} pixels'.format(image_xdim, image_ydim))
 
-        frames_total = count_rows*frames_per_run
+        frames_total = sum(x[1].n_frames for x in pst_rows)
 
         # Convert images to nifti files
         if convert_images:
             if concatenate_images:
                 print('Initializing volume for concatenating image files...')
-                B = np.zeros((xdim, ydim, frames_total))            
+                B = np.zeros((image_xdim, image_ydim, frames_total))
             if save_each_image:
-                os.system('mkdir ' + output_path_images)
+                frames = FrameStore(output_frames, 'w')
 
-            # Load table
-            spamReader = csv.reader(open(table_file, 'r'), delimiter="\t")
+            try:
+                # Loop through rows
+                count = 0
+                for row, pst1, pst2 in pst_rows:
 
-            # Loop through rows
-            count = 0
-            for row in spamReader:
-                if row[-1] == '2':
-                
                     # Extract elements from row
-                    file_lambda1 = os.path.join(in_path, row[3].replace('\\','/')) + '.pst'
-                    file_lambda2 = os.path.join(in_path, row[18].replace('\\','/')) + '.pst'
                     odor = row[2]
                     state = row[17]
 
                     # Print elements from row
-                    print('File wavelength 1:  ' + file_lambda1)
-                    print('File wavelength 2:  ' + file_lambda2)
+                    print('File wavelength 1:  ' + pst1.filename)
+                    print('File wavelength 2:  ' + pst2.filename)
                     #print('Stimulus frames:  ' + \
                     #       frame_stim1_on + '-' + frame_stim1_off + \
                     #       ' and ' + \
                     #       frame_stim2_on + '-' + frame_stim2_off)
                     print('State:  ' + state)
                     print('Odor:  ' + odor)
-            
-                    # Load .pst files for both wavelengths
-                    print('Loading .pst files...')
-                    raw1 = np.fromfile(file_lambda1, dtype='<i2')
-                    raw2 = np.fromfile(file_lambda2, dtype='<i2')
 
                     # Divide the first image by the second
+                    # (reading the .pst files for both wavelengths)
                     print('Dividing images for each of two wavelengths...')
-                    raw = (1.0 * raw1) / raw2
+                    raw = (1.0 * pst1.frames) / pst2.frames
 
                     # Loop through images
                     print('Concatenating resulting images...')
-                    for iframe in range(frames_per_run):
-                        image_vector = raw[iframe*xdim*ydim : (iframe+1)*xdim*ydim]
-                        image_matrix = np.reshape(image_vector, (xdim,ydim))
-    
+                    for iframe in range(pst1.n_frames):
+                        image_matrix = raw[iframe]
+
                         # Concatenate images to create one matrix per table
                         if concatenate_images:
                             B[:, :, count] = image_matrix
- 
+
                         count += 1
 
-                        # Save each ratio image as a nifti image
+                        # Save each ratio image in the frame store
                         if save_each_image:
-                            img_ratio_nib = nib.Nifti1Image(image_matrix, np.eye(4))
-                            img_ratio_nib.to_filename(os.path.join(output_path_images,'image'+str(count)+'.nii.gz'))
-  
+                            frames.append('image'+str(count), image_matrix)
+
+            finally:
+                if save_each_image:
+                    frames.close()
+
             # Save the concatenated nifti file
             print('Saving concatenated image volume')
             if concatenate_images:
@@ -164,30 +183,57 @@ for itable_file in table_files:
         #              -R target.nii transformWarp.nii.gz transformAffine.txt -use-NN 
         if correct_motion:
             print('Correcting motion...')
-            iframe_middle = np.int(frames_total/2)
-            image_ref = os.path.join(output_path_images,'image'+str(iframe_middle)+'.nii.gz')
-            for iframe in range(frames_total):
-                image = os.path.join(output_path_images,'image'+str(iframe+1)+'.nii.gz')
-                image_mc_stem = os.path.join(output_path_images,'image'+str(iframe+1)+'_motioncorrected')
-                image_mc = image_mc_stem + '.nii.gz'
-                cmd1 = ['ANTS 2 -m CC[',image_ref+',',image+',1,2] -o',image_mc,
-                        '-r Gauss[2,0] -t SyN[0.5] -i 30x99x11 --use-Histogram-Matching',
-                        '--number-of-affine-iterations 10000x10000x10000x10000x10000']
-                print(' '.join(cmd1))
-                os.system(' '.join(cmd1))
-                if save_affine:
-                    image_mc_affine = image_mc_stem + 'Affine.nii.gz'
-                    cmd2 = ['WarpImageMultiTransform 2',image,image_mc_affine,'-R',image_ref,
-                            image_mc_stem+'Affine.txt']
-                    print(' '.join(cmd2))
-                    os.system(' '.join(cmd2))
-                if save_nonlinear:
-                    image_mc_nonlinear = image_mc
-                    cmd3 = ['WarpImageMultiTransform 2',image,image_mc_nonlinear,'-R',image_ref,
-                            image_mc_stem+'Warp.nii.gz',
-                            image_mc_stem+'Affine.txt']
-                    print(' '.join(cmd3))
-                    os.system(' '.join(cmd3))
+            # Write the ratio images for ANTS, and keep its transform and
+            # output files, in a work directory (on tmpfs if it has room
+            # for about eight float images per frame)
+            work_dir = make_work_dir(nbytes=frames_total*image_xdim*image_ydim*8*8,
+                                     work_root=work_dir_root)
+            try:
+                with FrameStore(output_frames, 'a') as frames:
+                    iframe_middle = int(frames_total/2)
+                    image_ref = os.path.join(work_dir,'image'+str(iframe_middle)+'.nii')
+                    cmds_ants = []
+                    cmds_warp = []
+                    for iframe in range(frames_total):
+                        image = os.path.join(work_dir,'image'+str(iframe+1)+'.nii')
+                        nib.Nifti1Image(np.array(frames['image'+str(iframe+1)]), np.eye(4)).to_filename(image)
+                        image_mc_stem = os.path.join(work_dir,'image'+str(iframe+1)+'_motioncorrected')
+                        cmds_ants.append(['ANTS', '2', '-m', 'CC['+image_ref+','+image+',1,2]',
+                                          '-o', image_mc_stem+'.nii.gz',
+                                          '-r', 'Gauss[2,0]', '-t', 'SyN[0.5]', '-i', '30x99x11',
+                                          '--use-Histogram-Matching',
+                                          '--number-of-affine-iterations', '10000x10000x10000x10000x10000'])
+                        if save_affine:
+                            image_mc_affine = image_mc_stem + 'Affine.nii'
+                            cmds_warp.append(['WarpImageMultiTransform', '2', image, image_mc_affine,
+                                              '-R', image_ref, image_mc_stem+'Affine.txt'])
+                        if save_nonlinear:
+                            image_mc_nonlinear = image_mc_stem + '.nii'
+                            cmds_warp.append(['WarpImageMultiTransform', '2', image, image_mc_nonlinear,
+                                              '-R', image_ref, image_mc_stem+'Warp.nii.gz',
+                                              image_mc_stem+'Affine.txt'])
+                    # Compute all transforms, then apply them
+                    # (stop if any fail:  later stages need every frame)
+                    if report_failures(run_commands(cmds_ants, n_jobs)):
+                        raise RuntimeError('ANTS failed to register images for ' + table_file + '.')
+                    if report_failures(run_commands(cmds_warp, n_jobs)):
+                        raise RuntimeError('WarpImageMultiTransform failed for ' + table_file + '.')
+
+                    # Move the motion-corrected images into the frame store
+                    for iframe in range(frames_total):
+                        image_mc_stem = os.path.join(work_dir,'image'+str(iframe+1)+'_motioncorrected')
+                        if save_affine:
+                            image_mc_affine = nib.load(image_mc_stem + 'Affine.nii').get_data()
+                            frames.append('image'+str(iframe+1)+'_motioncorrectedAffine', image_mc_affine)
+                        if save_nonlinear:
+                            image_mc_nonlinear = nib.load(image_mc_stem + '.nii').get_data()
+                            frames.append('image'+str(iframe+1)+'_motioncorrected', image_mc_nonlinear)
+            except RuntimeError as error:
+                # Skip the remaining steps for this table, but go on to the next
+                print('Skipping ' + table_file + ':  ' + str(error))
+                continue
+            finally:
+                remove_work_dir(work_dir)
 
         # Smooth each motion-corrected image file.
         # Concatenate motion-corrected images.
@@ -195,97 +241,85 @@ for itable_file in table_files:
         if smooth_images:
             if concatenate_images:
                 print('Initializing volumes for motion-corrected and smoothed image files...')
-                Bc = np.zeros((xdim, ydim, frames_total))                      
+                Bc = np.zeros((image_xdim, image_ydim, frames_total))                      
                 if save_affine:
+                    # (the unsmoothed affine volume is only shown in montages)
+                    if save_montages or save_movie:
+                        Bc_affine = Bc.copy()
                     Bc_affine_smooth = Bc.copy()
                 if save_nonlinear:
                     Bc_nonlinear_smooth = Bc.copy()
-            for iframe in range(frames_total):
-                print('Smoothing and concatenating image ' + str(iframe+1))
-                image_mc_stem = os.path.join(output_path_images,'image'+str(iframe+1)+'_motioncorrected')
-                if save_affine:
-                    image_mc_affine = image_mc_stem + 'Affine.nii.gz'
-                    image_mc_affine_nib = nib.load(image_mc_affine)
-                    image_mc_affine = image_mc_affine_nib.get_data()
-                    # Smooth each image
-                    image_mc_affine_smooth = gaussian_filter(image_mc_affine, sigma=3, order=0)
-                if save_nonlinear:
-                    image_mc_nonlinear = image_mc_stem + '.nii.gz'
-                    image_mc_nib = nib.load(image_mc_nonlinear)
-                    image_mc = image_mc_nib.get_data()
-                    # Smooth each image
-                    image_mc_smooth = gaussian_filter(image_mc, sigma=3, order=0)
-
-                if concatenate_images:
-                    Bc[:, :, iframe] = image_mc
+            # Read motion-corrected images from (and add smoothed images to)
+            # the frame store through memory maps
+            with FrameStore(output_frames, 'a' if save_each_image else 'r') as frames:
+                for iframe in range(frames_total):
+                    print('Smoothing and concatenating image ' + str(iframe+1))
+                    image_mc_name = 'image'+str(iframe+1)+'_motioncorrected'
                     if save_affine:
-                        Bc_affine_smooth[:, :, iframe] = image_mc_affine_smooth 
+                        image_mc_affine = frames[image_mc_name + 'Affine']
+                        # Smooth each image
+                        image_mc_affine_smooth = gaussian_filter(image_mc_affine, sigma=3, order=0)
                     if save_nonlinear:
-                        Bc_nonlinear_smooth[:, :, iframe] = image_mc_smooth 
-                if save_each_image:
-                    if save_affine:
-                        image_mc_affine_smooth_nib = nib.Nifti1Image(image_mc_affine_smooth, np.eye(4))
-                        image_mc_affine_smooth_file = 'image'+str(iframe+1)+'_motioncorrectedAffine_smoothed.nii.gz'
-                        image_mc_affine_smooth_nib.to_filename(os.path.join(output_path_images,image_mc_affine_smooth_file))
-                    if save_nonlinear:
-                        image_mc_smooth_nib = nib.Nifti1Image(image_mc_smooth, np.eye(4))
-                        image_mc_smooth_file = 'image'+str(iframe+1)+'_motioncorrected_smoothed.nii.gz'
-                        image_mc_smooth_nib.to_filename(os.path.join(output_path_images,image_mc_smooth_file))
+                        image_mc = frames[image_mc_name]
+                        # Smooth each image
+                        image_mc_smooth = gaussian_filter(image_mc, sigma=3, order=0)
+
+                    if concatenate_images:
+                        Bc[:, :, iframe] = image_mc
+                        if save_affine:
+                            if save_montages or save_movie:
+                                Bc_affine[:, :, iframe] = image_mc_affine
+                            Bc_affine_smooth[:, :, iframe] = image_mc_affine_smooth 
+                        if save_nonlinear:
+                            Bc_nonlinear_smooth[:, :, iframe] = image_mc_smooth 
+                    if save_each_image:
+                        if save_affine:
+                            frames.append(image_mc_name + 'Affine_smoothed', image_mc_affine_smooth)
+                        if save_nonlinear:
+                            frames.append(image_mc_name + '_smoothed', image_mc_smooth)
 
             # Save the concatenated nifti files
             if concatenate_images:
                 Bc_nib = nib.Nifti1Image(Bc, np.eye(4))
                 Bc_nib.to_filename(output_stem + '_motioncorrected.nii.gz')
                 if save_affine:
+                    if save_montages or save_movie:
+                        Bc_affine_nib = nib.Nifti1Image(Bc_affine, np.eye(4))
+                        Bc_affine_nib.to_filename(output_stem + '_motioncorrectedAffine.nii.gz')
                     Bc_affine_smooth_nib = nib.Nifti1Image(Bc_affine_smooth, np.eye(4))
                     Bc_affine_smooth_nib.to_filename(output_stem + '_motioncorrectedAffine_smoothed.nii.gz')
                 if save_nonlinear:
                     Bc_nonlinear_smooth_nib = nib.Nifti1Image(Bc_nonlinear_smooth, np.eye(4))
                     Bc_nonlinear_smooth_nib.to_filename(output_stem + '_motioncorrected_smoothed.nii.gz')
 
-        # Convert each nifti image file to jpg and to png and save a montage of preprocessed images
-        if save_montages:
-            for iframe in range(frames_total):
-                print('Converting nifti to jpg and png image and creating a montage for' + str(iframe+1))
-                image_stem = os.path.join(output_path_images,'image'+str(iframe+1))
-                output_montage = os.path.join(output_path_images,'montage'+str(iframe+1))+'.png'
-                cmd = ['ConvertToJpg',image_stem+'.nii.gz',image_stem+'.jpg']
-                print(' '.join(cmd)); os.system(' '.join(cmd))                
-                cmd = ['convert',image_stem+'.jpg',image_stem+'.png']
-                print(' '.join(cmd)); os.system(' '.join(cmd))                
-                image_mc_stem = os.path.join(output_path_images,'image'+str(iframe+1)+'_motioncorrected')
+        # Save a montage of preprocessed images for each frame, and a movie of the montages
+        if save_montages or save_movie:
+            print('Rendering montages of preprocessed images...')
+            # Use the concatenated volumes in memory, or else load them
+            if convert_images and smooth_images and concatenate_images:
+                volumes = [B]
+                if save_affine:
+                    volumes.append(Bc_affine)
+                if save_nonlinear:
+                    volumes.extend([Bc, Bc_nonlinear_smooth])
+            else:
+                suffixes = ['']
                 if save_affine:
-                    image_mc_affine_stem = image_mc_stem + 'Affine'
-                    cmd = ['ConvertToJpg',image_mc_affine_stem+'.nii.gz',image_mc_affine_stem+'.jpg']
-                    print(' '.join(cmd)); os.system(' '.join(cmd))                
-                    cmd = ['convert',image_mc_affine_stem+'.jpg',image_mc_affine_stem+'.png']
-                    print(' '.join(cmd)); os.system(' '.join(cmd))                
-                    image_mc_affine_sm_stem = image_mc_affine_stem + '_smoothed'
-                    cmd = ['ConvertToJpg',image_mc_affine_sm_stem+'.nii.gz',image_mc_affine_sm_stem+'.jpg']
-                    print(' '.join(cmd)); os.system(' '.join(cmd))                
-                    cmd = ['convert',image_mc_affine_sm_stem+'.jpg',image_mc_affine_sm_stem+'.png']
-                    print(' '.join(cmd)); os.system(' '.join(cmd))                
+                    suffixes.append('_motioncorrectedAffine')
                 if save_nonlinear:
-                    cmd = ['ConvertToJpg',image_mc_stem+'.nii.gz',image_mc_stem+'.jpg']
-                    print(' '.join(cmd)); os.system(' '.join(cmd))                
-                    cmd = ['convert',image_mc_stem+'.jpg',image_mc_stem+'.png']
-                    print(' '.join(cmd)); os.system(' '.join(cmd))                
-                    image_mc_sm_stem = image_mc_stem + '_smoothed'
-                    cmd = ['ConvertToJpg',image_mc_sm_stem+'.nii.gz',image_mc_sm_stem+'.jpg']
-                    print(' '.join(cmd)); os.system(' '.join(cmd))                
-                    cmd = ['convert',image_mc_sm_stem+'.jpg',image_mc_sm_stem+'.png']
-                    print(' '.join(cmd)); os.system(' '.join(cmd))                
-                cmd = ['montage',
-                       image_stem+'.png',
-                       image_mc_affine_stem+'.png',
-                       image_mc_stem+'.png',
-                       image_mc_sm_stem+'.png',
-                       '-label ' + str(iframe+1),
-                       '-geometry +1+0 -tile 4x -background black',
-                       output_montage]
-                print(' '.join(cmd)); os.system(' '.join(cmd))                
-        if save_movie:
-            input_montages = os.path.join(output_path_images,'montage*.png')
-            output_montage_movie = output_stem + '_montages.gif'
-            cmd = ['convert',input_montages,'-adjoin -compress none',output_montage_movie]
-            print(' '.join(cmd)); os.system(' '.join(cmd))                
+                    suffixes.extend(['_motioncorrected', '_motioncorrected_smoothed'])
+                volumes = []
+                for suffix in suffixes:
+                    if suffix == '_motioncorrectedAffine' and \
+                       not os.path.exists(output_stem + suffix + '.nii.gz'):
+                        # Saved only for montages:  restack it from the frame store
+                        with FrameStore(output_frames) as frames:
+                            volumes.append(np.dstack([frames['image'+str(iframe+1)+suffix]
+                                                      for iframe in range(frames_total)]))
+                    else:
+                        volumes.append(nib.load(output_stem + suffix + '.nii.gz').get_data())
+            if save_montages and not os.path.exists(output_path_images):
+                os.mkdir(output_path_images)
+            output_montages = output_path_images if save_montages else None
+            output_montage_movie = output_stem + '_montages.gif' if save_movie else None
+            render_montages.save_montages(volumes, output_montages, output_montage_movie, n_jobs)
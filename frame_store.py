@@ -0,0 +1,145 @@
+#!/usr/bin/python
+"""
+Store many per-frame images in one indexed container file.
+
+Instead of writing every frame as its own small nifti file
+(image1.nii.gz, image1_motioncorrected.nii.gz, ...), frames are appended
+to a single file and looked up by name through an offsets table.
+
+File layout:
+    header:  8-byte magic, then the byte offset and byte length of the table
+             (little-endian unsigned 64-bit integers)
+    frames:  raw array data, one frame after another
+    table:   JSON list of [name, offset, shape, dtype] for each frame
+
+(1) Reading a frame is O(1):  a table lookup, then a read-only memory map.
+(2) Appending a frame writes its data at the end of the file, leaving the
+    old table in place; a new table is written after the last frame, and the
+    header pointed at it, when the store is flushed or closed.  Until then
+    the header still points to the old table, so an interrupted session
+    loses only the frames appended since the last flush.
+(3) Appending a frame with an existing name points the name at the new data.
+
+Example:
+    from frame_store import FrameStore
+    with FrameStore('output/bee1_images.frames', 'w') as store:
+        store.append('image1', image_matrix)
+    with FrameStore('output/bee1_images.frames') as store:
+        image = store['image1']
+"""
+
+import os
+import json
+import struct
+import numpy as np
+
+magic = b'BEEFRAME'
+header_format = '<8sQQ'
+header_size = struct.calcsize(header_format)
+
+
+class FrameStore(object):
+    """Indexed container of named frames (see module docstring)
+    filename = container file name
+    mode = 'r' to read, 'a' to read and append, 'w' to start a new file
+    """
+    def __init__(self, filename, mode='r'):
+        if mode not in ('r', 'a', 'w'):
+            raise ValueError("mode must be one of 'r', 'a', 'w'")
+        self.filename = filename
+        self.mode = mode
+        self.index = {}
+        self.names = []
+        if mode == 'w' or (mode == 'a' and not os.path.exists(filename)):
+            self.file = open(filename, 'w+b')
+            self.end = header_size
+            self.changed = True
+            self.flush()
+        else:
+            self.file = open(filename, 'rb' if mode == 'r' else 'r+b')
+            self.read_table()
+            self.changed = False
+
+    def read_table(self):
+        """Read the header and offsets table
+        """
+        header = self.file.read(header_size)
+        if len(header) < header_size or header[:len(magic)] != magic:
+            raise IOError(self.filename + ' is not a frame store file.')
+        magic_read, table_offset, table_length = \
+            struct.unpack(header_format, header)
+        self.file.seek(table_offset)
+        try:
+            table = json.loads(self.file.read(table_length).decode('utf-8'))
+            for name, offset, shape, dtype in table:
+                if name not in self.index:
+                    self.names.append(name)
+                self.index[name] = (offset, tuple(shape), dtype)
+        except (ValueError, TypeError):
+            raise IOError(self.filename + ' has a corrupt offsets table.')
+        self.file.seek(0, os.SEEK_END)
+        self.end = self.file.tell()
+
+    def append(self, name, frame):
+        """Append a frame (numpy array) under the given name
+        """
+        if self.mode == 'r':
+            raise IOError(self.filename + ' is open for reading only.')
+        frame = np.ascontiguousarray(frame)
+        self.file.seek(self.end)
+        self.file.write(frame.tobytes())
+        if name not in self.index:
+            self.names.append(name)
+        self.index[name] = (self.end, frame.shape, frame.dtype.str)
+        self.end += frame.nbytes
+        self.changed = True
+
+    def __getitem__(self, name):
+        """Return a read-only memory map of the named frame
+        """
+        offset, shape, dtype = self.index[name]
+        if self.mode != 'r':
+            self.file.flush()
+        if not np.prod(shape):
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self.filename, dtype=dtype, mode='r',
+                         offset=offset, shape=shape)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.names)
+
+    def flush(self):
+        """Write a new offsets table after the last frame, then point the
+        header at it (the old table stays valid until the header is updated)
+        """
+        if self.mode == 'r' or not self.changed:
+            return
+        table = [[name] + list(self.index[name]) for name in self.names]
+        table = json.dumps(table).encode('utf-8')
+        table_offset = self.end
+        self.file.seek(table_offset)
+        self.file.write(table)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.end = table_offset + len(table)
+        self.file.seek(0)
+        self.file.write(struct.pack(header_format, magic, table_offset,
+                                    len(table)))
+        self.file.flush()
+        self.changed = False
+
+    def close(self):
+        """Write the offsets table (if changed) and close the file
+        """
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
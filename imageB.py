@@ -22,6 +22,8 @@ Preprocessing steps:
     and save slice stack in nifti (neuroimaging file) format.
 (3) Apply FSL's motion correction.
 (4) Smooth each slice image with a Gaussian kernel.
+(5) Compute quality control measures (global signal, DVARS, framewise
+    displacement, temporal SNR, zero/saturated pixel counts) and flag bad runs.
 
 Processing steps:
 
@@ -37,7 +39,8 @@ Plotting steps:
 (1) Create a figure whose color indicates effect size and opacity reflects statistical significance
 (2) Draw overlay and contour around a statistical threshold
 
-Outputs: Nifti and .png image files for each table (for each bee).
+Outputs: Nifti and .png image files for each table (for each bee),
+         and quality control measures with a summary table for each bee.
 
 Requirements:
 * Python libraries:  nibabel, numpy, scipy, nipy
@@ -79,13 +82,20 @@ import pylab as mp
 from nipy.modalities.fmri.design_matrix import make_dmtx
 from nipy.modalities.fmri.experimental_paradigm import BlockParadigm
 from nipy.modalities.fmri.glm import GeneralLinearModel, data_scaling
+from run_tools import run_command, report_failures
+from quality_control import count_bad_pixels, global_signal, dvars, \
+    temporal_snr, read_motion_parameters, framewise_displacement, \
+    summarize_runs, write_summary
+from pst_format import open_pst, check_geometry
 
 #=============================================================================
 # Settings
 #=============================================================================
-xdim = 130  # x dimension for each image
-ydim = 172  # y dimension for each image
-images_per_run = 232  # number of images for a given set of conditions (or bee)
+xdim = None  # x dimension for each image (None = detect)
+ydim = None  # y dimension for each image (None = detect)
+images_per_run = None  # number of images for a given set of conditions (or bee)
+                       # (None = detect:  from the .pst files when converting
+                       #  images, else from the saved ratio/moco/smooth images)
 onset_list = [73, 93]
 duration_list = [11, 11]
 amplitude_list = [0.000001, 0.0001, 0.001, 0.01]
@@ -93,6 +103,9 @@ smooth_sigma = 3  # sigma of Gaussian kernel
 zthresh = 3.74  # threshold zvalues
 max_effect = 100  # maximum effect size
 ext = '.nii.gz'  # output file extension
+saturation_value = 32767  # camera pixel value at (or above) saturation
+max_mean_fd = 0.5  # flag runs whose mean framewise displacement exceeds this
+max_bad_pixel_fraction = 0.01  # flag runs with more zero/saturated pixels
 
 #-----------------------------------------------------------------------------
 # Run processing steps (1=True, 0=False)
@@ -101,6 +114,9 @@ convert_images = 0  # convert .pst image slice stack to 2D nifti files
 divide_images  = 0  # divide one wavelength's image volume by the other
 correct_motion = 0  # apply registration to correct for motion
 smooth_images  = 0  # smooth the resulting motion-corrected images
+qc_images      = 1  # compute quality control measures and flag bad runs
+skip_flagged_runs = 0  # skip analysis of tests with runs flagged by QC
+                       # (0 = only flag them in the QC summary)
 run_analysis   = 1
 ntests = 5
 plot_design_matrix = 1
@@ -119,6 +135,12 @@ stop1_column = 7
 start2_column = 8
 stop2_column = 9
 
+# Table rows of each test's wavelength 1 and wavelength 2 .pst files
+lambda1_rows = {1: [9], 2: [19], 3: [3, 5, 7, 9], 4: [13, 15, 17, 19],
+                5: [9, 19]}  # test 5: asleep, then awake
+lambda2_rows = {1: [10], 2: [20], 3: [4, 6, 8, 10], 4: [14, 16, 18, 20],
+                5: [10, 20]}
+
 #-----------------------------------------------------------------------------
 # Command-line arguments and output file names
 #-----------------------------------------------------------------------------
@@ -180,11 +202,73 @@ def draw_overlay(E,Z, thresh=3.):
     mp.imshow(mycmap(E, Z, thresh))
     mp.contour(Z > thresh, 1)
 
+def open_table_images(table_file, images_dir, rows):
+    """Open the .pst files listed in the given rows of a table (where they exist)
+    Returns a dictionary of PstFile objects keyed by row index.
+    """
+    pst_files = {}
+    try:
+        csv_reader = csv.reader(open(table_file, 'r'), dialect=csv.excel_tab)
+    except IOError:
+        print("  Cannot open " + table_file + ".")
+        return pst_files
+    for irow, row in enumerate(csv_reader):
+        if irow in rows and len(row) > image_file_column:
+            file = os.path.join(images_dir, row[image_file_column])
+            if os.path.isfile(file):
+                pst_files[irow] = open_pst(file, xdim, ydim, images_per_run)
+    return pst_files
+
+def saved_image_geometry(tests):
+    """Read the image geometry from the first saved (ratio, motion-corrected,
+    or smoothed) image volume of the given tests
+    Returns (xdim, ydim, images per run), or None if no volume is found.
+    """
+    for ntest in tests:
+        for stage in ['ratio', 'moco', 'smooth']:
+            file = os.path.join(out_path, label + stage + '_test' + str(ntest) + ext)
+            if os.path.isfile(file):
+                shape = nb.load(file).shape
+                n_runs = len(lambda1_rows[ntest])
+                if shape[-1] % n_runs == 0:
+                    return shape[0], shape[1], shape[-1] // n_runs
+    return None
+
+#=============================================================================
+# Read (or detect) the image geometry and number of images per run
+#=============================================================================
+pst_files = {}
+if convert_images:
+    used_rows = set(x for itest in range(ntests)
+                    for x in lambda1_rows[itest + 1] + lambda2_rows[itest + 1])
+    pst_files = open_table_images(table_file, images_dir, used_rows)
+    if pst_files:
+        xdim, ydim, images_per_run = check_geometry(pst_files.values())
+    elif None in (xdim, ydim, images_per_run):
+        print("\n\t Cannot find .pst files in " + table_file + " to detect " + \
+              "the image geometry: set xdim, ydim and images_per_run.")
+        sys.exit()
+elif None in (xdim, ydim, images_per_run):
+    geometry = saved_image_geometry(range(1, ntests + 1))
+    if geometry is None:
+        print("\n\t Cannot find saved images in " + out_path + " to detect " + \
+              "the image geometry: set xdim, ydim and images_per_run.")
+        sys.exit()
+    xdim = xdim or geometry[0]
+    ydim = ydim or geometry[1]
+    images_per_run = images_per_run or geometry[2]
+print('Images:  {0} x {1} pixels, {2} per run'.format(xdim, ydim,
+                                                     images_per_run))
+
 #=============================================================================
 # Loop through tests
 #=============================================================================
+qc_summary_file = os.path.join(out_path, label + 'qc_summary.txt')
+qc_rows = []
 for itest in range(ntests):
     ntest = itest + 1
+    rows_lambda1 = lambda1_rows[ntest]
+    rows_lambda2 = lambda2_rows[ntest]
 
     #=========================================================================
     # Models for analysis
@@ -195,8 +279,6 @@ for itest in range(ntests):
         #---------------------------------------------------------------------
         desc = 'Odor vs. no odor: asleep (max. concentration)'
         print(desc)
-        rows_lambda1 = [9]
-        rows_lambda2 = [10]
         conditions = [0, 0]
         amplitudes = [1, 1]
         onsets = [onset_list[0], onset_list[1]]
@@ -207,8 +289,6 @@ for itest in range(ntests):
         #---------------------------------------------------------------------
         desc = 'Odor vs. no odor: awake (max. concentration)'
         print(desc)
-        rows_lambda1 = [19]
-        rows_lambda2 = [20]
         conditions = [0, 0]
         amplitudes = [1, 1]
         onsets = [onset_list[0], onset_list[1]]
@@ -219,8 +299,6 @@ for itest in range(ntests):
         #---------------------------------------------------------------------
         desc = 'Effect of odor concentration: asleep'
         print(desc)
-        rows_lambda1 = [3, 5, 7, 9]
-        rows_lambda2 = [4, 6, 8, 10]
         n_runs = len(rows_lambda1)
         conditions = np.zeros(2 * len(amplitude_list), dtype=int).tolist()
         conditions.extend([x + 1 for x in range(n_runs)])
@@ -247,8 +325,6 @@ for itest in range(ntests):
         #---------------------------------------------------------------------
         desc = 'Effect of odor concentration: awake'
         print(desc)
-        rows_lambda1 = [13, 15, 17, 19]
-        rows_lambda2 = [14, 16, 18, 20]
         n_runs = len(rows_lambda1)
         conditions = np.zeros(2 * len(amplitude_list), dtype=int).tolist()
         conditions.extend([x + 1 for x in range(n_runs)])
@@ -275,14 +351,6 @@ for itest in range(ntests):
         #---------------------------------------------------------------------
         desc = 'Asleep vs. awake (max. concentration)'
         print(desc)
-        rows_lambda1_asleep = [9]
-        rows_lambda2_asleep = [10]
-        rows_lambda1_awake = [19]
-        rows_lambda2_awake = [20]
-        rows_lambda1 = rows_lambda1_asleep
-        rows_lambda1.extend(rows_lambda1_awake)
-        rows_lambda2 = rows_lambda2_asleep
-        rows_lambda2.extend(rows_lambda2_awake)
         conditions = [0, 0, 0, 0, 1, 2]
         amplitudes = [1, 1, 1, 1, 1, 1]
         onsets = [onset_list[0], onset_list[1],
@@ -299,6 +367,11 @@ for itest in range(ntests):
     ratio_file = os.path.join(out_path, label + 'ratio_test' + str(ntest) + ext)
     moco_file =  os.path.join(out_path, label + 'moco_test' + str(ntest) + ext)
     smooth_file = os.path.join(out_path, label + 'smooth_test' + str(ntest) + ext)
+    qc_file = os.path.join(out_path, label + 'qc_test' + str(ntest) + '.npz')
+    tsnr_file = os.path.join(out_path, label + 'tsnr_test' + str(ntest) + ext)
+    zero_pixels = np.nan * np.ones(n_images)
+    saturated_pixels = np.nan * np.ones(n_images)
+    flagged = False
     #-------------------------------------------------------------------------
     # Divide the .pst image files corresponding to one wavelength by those
     # corresponding to a second wavelength (assumed to be co-registered),
@@ -307,52 +380,38 @@ for itest in range(ntests):
     if convert_images:
         print('Convert images...')
 
-        # Load table
-        try:
-            csv_reader = csv.reader(open(table_file, 'rU'), dialect=csv.excel_tab)
-        except IOError:
-            print("  Cannot open " + table_file + ".")
-
         # Loop through wavelength 1 rows and stack images
         count = 0
         image_stack = np.zeros((xdim, ydim, 1, n_images), dtype=float)
-        for irow, row in enumerate(csv_reader):
-            if irow in rows_lambda1:
-                # Load .pst file containing multiple images
-                file = os.path.join(images_dir, row[image_file_column])
-                print('  Loading ' + file + ' and stacking images...')
-                raw = np.fromfile(file, dtype='<i2')
-                for iframe in range(images_per_run):
-                    image_vector = raw[iframe * xdim * ydim :
-                                       (iframe + 1) * xdim * ydim]
-                    image_matrix = np.reshape(image_vector, (xdim, ydim))
-                    # Stack
-                    image_stack[:, :, 0, count] = image_matrix
-                    count += 1
-
-        # Reload table
-        try:
-            csv_reader = csv.reader(open(table_file, 'rU'), dialect=csv.excel_tab)
-        except IOError:
-            print("  Cannot open " + table_file + ".")
+        for irow in sorted(rows_lambda1):
+            if irow not in pst_files:
+                raise IOError("Cannot find the .pst file in row " + str(irow) +
+                              " of " + table_file + ".")
+            # Read frames from the .pst file containing multiple images
+            pst = pst_files[irow]
+            print('  Loading ' + pst.filename + ' and stacking images...')
+            image_stack[:, :, 0, count:count + pst.n_frames] = \
+                np.transpose(pst.frames, (1, 2, 0))
+            count += pst.n_frames
 
         # Loop through wavelength 2 rows and divide wavelength 1 images
         count = 0
-        for irow, row in enumerate(csv_reader):
-            if irow in rows_lambda2:
-                # Load .pst file containing multiple images
-                file = os.path.join(images_dir, row[image_file_column])
-                print('  Loading ' + file + ' and dividing wavelength images...')
-                raw = np.fromfile(file, dtype='<i2')
-                for iframe in range(images_per_run):
-                    image_vector = raw[iframe * xdim * ydim :
-                                       (iframe + 1) * xdim * ydim]
-                    image_matrix = np.reshape(image_vector, (xdim, ydim))
-                    # Divide first by second wavelength (alternate rows)
-                    # NOTE: two wavelength images assumed to be co-registered
-                    image_stack[:, :, 0, count] = \
-                    image_stack[:, :, 0, count] / image_matrix
-                    count += 1
+        for irow in sorted(rows_lambda2):
+            if irow not in pst_files:
+                raise IOError("Cannot find the .pst file in row " + str(irow) +
+                              " of " + table_file + ".")
+            # Read frames from the .pst file containing multiple images
+            pst = pst_files[irow]
+            print('  Loading ' + pst.filename + ' and dividing wavelength images...')
+            frames = slice(count, count + pst.n_frames)
+            # Count zero-denominator and saturated pixels
+            zero_pixels[frames], saturated_pixels[frames] = \
+                count_bad_pixels(pst.frames, saturation_value)
+            # Divide first by second wavelength (alternate rows)
+            # NOTE: two wavelength images assumed to be co-registered
+            image_stack[:, :, 0, frames] = \
+            image_stack[:, :, 0, frames] / np.transpose(pst.frames, (1, 2, 0))
+            count += pst.n_frames
 
         nb.save(nb.Nifti1Image(image_stack, np.eye(4)), ratio_file)
 
@@ -361,23 +420,75 @@ for itest in range(ntests):
     #-------------------------------------------------------------------------
     if correct_motion:
         print('Correcting motion...')
-        cmd = ['  mcflirt -in', ratio_file, '-out', moco_file]
-        print(' '.join(cmd)); os.system(' '.join(cmd))
+        cmd = ['mcflirt', '-in', ratio_file, '-out', moco_file, '-plots']
+        if report_failures([run_command(cmd)]):
+            print('  Skipping the rest of test ' + str(ntest) + '.')
+            continue
 
     #-------------------------------------------------------------------------
     # Smooth each slice image with a Gaussian kernel
     #-------------------------------------------------------------------------
     if smooth_images:
         print('Smoothing image')
-        cmd = ['  fslmaths', moco_file, '-s', str(smooth_sigma), smooth_file]
-        print(' '.join(cmd)); os.system(' '.join(cmd))
+        cmd = ['fslmaths', moco_file, '-s', str(smooth_sigma), smooth_file]
+        if report_failures([run_command(cmd)]):
+            print('  Skipping the rest of test ' + str(ntest) + '.')
+            continue
+
+    #-------------------------------------------------------------------------
+    # Compute quality control measures and flag bad runs
+    # (zero/saturated pixel counts come from converting images above)
+    #-------------------------------------------------------------------------
+    if qc_images and not os.path.exists(moco_file):
+        print('Skipping quality control:  cannot find ' + moco_file + '.')
+    elif qc_images:
+        print('Computing quality control measures...')
+        if not convert_images and os.path.exists(qc_file):
+            # Reuse pixel counts from when the images were converted
+            saved = np.load(qc_file)
+            if len(saved['zero_pixels']) == n_images:
+                zero_pixels = saved['zero_pixels']
+                saturated_pixels = saved['saturated_pixels']
+        moco = nb.load(moco_file).get_data()
+        qc_mask = np.sum(moco, axis=-1) > 0
+        motion = read_motion_parameters(moco_file)
+        if motion is None:
+            print('  No motion parameters found for ' + moco_file + '.')
+            motion = np.nan * np.ones((n_images, 6))
+        qc = {'global_signal': global_signal(moco, qc_mask),
+              'dvars': dvars(moco, qc_mask),
+              'fd': framewise_displacement(motion),
+              'motion': motion,
+              'zero_pixels': zero_pixels,
+              'saturated_pixels': saturated_pixels}
+        np.savez(qc_file, **qc)
+        tsnr = [temporal_snr(moco[..., irun * images_per_run:
+                                       (irun + 1) * images_per_run])
+                for irun in range(len(rows_lambda1))]
+        nb.save(nb.Nifti1Image(np.stack(tsnr, axis=-1), np.eye(4)), tsnr_file)
+
+        test_rows = summarize_runs(ntest, qc, tsnr, images_per_run,
+                                   xdim * ydim, max_mean_fd,
+                                   max_bad_pixel_fraction)
+        qc_rows = [x for x in qc_rows if x['test'] != ntest] + test_rows
+        write_summary(qc_rows, qc_summary_file)
+        flagged_runs = [x['run'] for x in test_rows if x['flagged']]
+        if flagged_runs:
+            flagged = True
+            print('  Runs flagged by quality control: {}'.format(flagged_runs))
+        for row in test_rows:
+            if row['missing']:
+                print('  Run {0} is missing measures: {1}'.format(row['run'],
+                                                                row['missing']))
 
     #=========================================================================
     # Conduct a general linear model analysis on the preprocessed images per test
     # (Requires the preprocessed image and the following paradigm lists from above:
     #  conditions, onsets, durations, amplitudes)
     #=========================================================================
-    if run_analysis:
+    if run_analysis and flagged and skip_flagged_runs:
+        print('Skipping general linear model analysis of flagged runs.')
+    elif run_analysis:
         ('Run general linear model analysis for each test...')
         img = nb.load(smooth_file)
 
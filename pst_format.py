@@ -0,0 +1,150 @@
+#!/usr/bin/python
+"""
+Read .pst image stacks of any sensor geometry.
+
+A .pst file is a headerless stack of 2-byte integer images.  Rather than
+assuming one camera configuration, each file's geometry is read or inferred:
+
+(1) The byte order is given explicitly, or else detected from the start
+    of the file (camera counts are non-negative, so the byte order that gives
+    fewer negative values, then smaller values, is chosen).
+(2) Image dimensions are given explicitly, or else taken from the table of
+    known sensor geometries (binned and unbinned):  the entry that evenly
+    divides the file and gives the expected number of frames.  The known
+    geometries differ by factors of 4 in size, so a file can fit several;
+    without an expected number of frames, the one giving the usual run
+    length (default_frames) is chosen, and if that does not settle it,
+    an error asks for the dimensions or number of frames.
+(3) The number of frames is computed from the file size.
+(4) Frames are read lazily, through a read-only memory map.
+
+Example:
+    from pst_format import open_pst
+    pst = open_pst('data/Bee1_lr120313l.pst')
+    print(pst.xdim, pst.ydim, pst.n_frames, pst.dtype)
+    image_matrix = pst.frames[0]  # (xdim, ydim) array
+"""
+
+import os
+import numpy as np
+
+# Known sensor geometries (xdim, ydim), in order of preference
+known_geometries = [(130, 172),  # binned
+                    (260, 344),  # unbinned
+                    (65, 86)]    # binned further
+value_type = 'i2'  # 2-byte integers
+default_frames = 232  # usual number of frames per run
+
+
+class PstFile(object):
+    """A .pst image stack with its geometry, frame count, and data type
+    Frames are available lazily as pst.frames, an (n_frames, xdim, ydim)
+    read-only memory map.
+    """
+    def __init__(self, filename, xdim, ydim, n_frames, dtype):
+        self.filename = filename
+        self.xdim = xdim
+        self.ydim = ydim
+        self.n_frames = n_frames
+        self.dtype = np.dtype(dtype)
+        self._frames = None
+
+    @property
+    def frames(self):
+        if self._frames is None:
+            self._frames = np.memmap(self.filename, dtype=self.dtype, mode='r',
+                shape=(self.n_frames, self.xdim, self.ydim))
+        return self._frames
+
+    def __len__(self):
+        return self.n_frames
+
+    def __repr__(self):
+        return '{0}({1!r}, xdim={2}, ydim={3}, n_frames={4}, dtype={5!r})'.\
+            format(type(self).__name__, self.filename, self.xdim, self.ydim,
+                   self.n_frames, self.dtype.str)
+
+
+def infer_geometry(n_values, xdim=None, ydim=None, n_frames=None):
+    """Find image dimensions that evenly divide a file of n_values values
+    xdim, ydim = known image dimensions (None to look up known_geometries)
+    n_frames = expected number of frames (None if unknown:  then, if several
+               geometries fit, the one giving default_frames frames is chosen)
+    Returns (xdim, ydim, n_frames).
+    """
+    if xdim and ydim:
+        candidates = [(xdim, ydim)]
+    else:
+        candidates = [x for x in known_geometries
+                      if xdim in (None, x[0]) and ydim in (None, x[1])]
+    fits = [(x, y) for x, y in candidates
+            if n_values and n_values % (x * y) == 0 and
+            n_frames in (None, n_values // (x * y))]
+    if not fits:
+        raise ValueError('{0} values do not fit any image geometry {1}{2}.'.
+            format(n_values, candidates, '' if n_frames is None
+                   else ' with {0} frames'.format(n_frames)))
+    if len(fits) > 1 and n_frames is None:
+        usual = [(x, y) for x, y in fits
+                 if n_values // (x * y) == default_frames]
+        if usual:
+            fits = usual
+    if len(fits) > 1:
+        raise ValueError('{0} values fit several image geometries {1}: '
+                         'set the image dimensions or number of frames.'.
+                         format(n_values, fits))
+    x, y = fits[0]
+    return x, y, n_values // (x * y)
+
+
+def detect_byteorder(sample):
+    """Choose the byte order ('<' or '>') that makes sample look like
+    camera counts:  fewest negative values, then smallest values
+    sample = raw bytes holding whole value_type values
+    """
+    scores = []
+    for byteorder in ['<', '>']:
+        values = np.frombuffer(sample, dtype=byteorder + value_type)
+        scores.append((np.sum(values < 0), np.mean(np.abs(values.astype(float)))
+                       if values.size else 0, byteorder))
+    return min(scores)[2]
+
+
+def open_pst(filename, xdim=None, ydim=None, n_frames=None, byteorder=None):
+    """Open a .pst file, reading or inferring its geometry and byte order
+    xdim, ydim = image dimensions (None to infer)
+    n_frames = expected number of frames (None to compute from the file size)
+    byteorder = '<' (little-endian) or '>' (big-endian) (None to detect)
+    Returns a PstFile.
+    """
+    itemsize = np.dtype(value_type).itemsize
+    nbytes = os.path.getsize(filename)
+    if nbytes % itemsize:
+        raise ValueError(filename + ' is not a stack of ' +
+                         str(itemsize) + '-byte values.')
+
+    try:
+        xdim, ydim, n_frames = infer_geometry(nbytes // itemsize, xdim, ydim,
+                                              n_frames)
+    except ValueError as error:
+        raise ValueError(filename + ': ' + str(error))
+    if byteorder is None:
+        # Detect the byte order from the first frame
+        with open(filename, 'rb') as f:
+            byteorder = detect_byteorder(f.read(xdim * ydim * itemsize))
+    return PstFile(filename, xdim, ydim, n_frames, byteorder + value_type)
+
+
+def check_geometry(pst_files, n_frames=True):
+    """Check that .pst files share image dimensions (and frame counts)
+    n_frames = also require the same number of frames
+    Returns (xdim, ydim, frames per file or None).
+    """
+    if not pst_files:
+        raise ValueError('No .pst files to check.')
+    geometries = set((x.xdim, x.ydim, x.n_frames if n_frames else None)
+                     for x in pst_files)
+    if len(geometries) != 1:
+        raise ValueError('.pst files differ in geometry: ' +
+                         ', '.join(repr(x) for x in pst_files))
+    return geometries.pop()
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+"""
+Compute quality control measures for preprocessed bee brain images.
+
+Per-frame measures:
+(1) global signal:  mean intensity within the mask
+(2) DVARS:  root mean square of the intensity change from the previous frame
+(3) framewise displacement:  summed absolute change in the motion parameters
+    (rotations converted to displacements on a circle of a given radius)
+(4) zero-denominator and saturated pixel counts in the second wavelength
+
+Per-pixel measures:
+(5) temporal signal-to-noise ratio (tSNR):  temporal mean / standard deviation
+
+Per-run measures summarize the above, and flag runs whose mean framewise
+displacement or fraction of bad pixels exceeds a threshold, so that they
+can be dropped before running a general linear model.  Runs missing either
+measure (no motion parameters or pixel counts) are flagged as well, with the
+missing measures listed, rather than passed unchecked.
+
+Example:
+    from quality_control import *
+    gs, dv = global_signal(data, mask), dvars(data, mask)
+    fd = framewise_displacement(read_motion_parameters(moco_file))
+"""
+
+import os
+import csv
+import numpy as np
+
+summary_columns = ['test', 'run', 'frames', 'mean_fd', 'max_fd', 'mean_dvars',
+                   'median_tsnr', 'zero_pixels', 'saturated_pixels', 'flagged',
+                   'missing']
+
+
+def count_bad_pixels(image, saturation_value):
+    """Count zero-valued and saturated pixels in a denominator image
+    image = (xdim, ydim) image, or (frames, xdim, ydim) stack of images
+    Returns (number of zero pixels, number of saturated pixels),
+    per frame for a stack.
+    """
+    return np.sum(image == 0, axis=(-2, -1)), \
+           np.sum(image >= saturation_value, axis=(-2, -1))
+
+
+def frames_by_pixels(data, mask=None):
+    """Reshape image data (..., frames) to a (frames, pixels) array
+    """
+    data = np.asarray(data)
+    if mask is not None:
+        return data[mask].T
+    return np.reshape(data, (-1, data.shape[-1])).T
+
+
+def global_signal(data, mask=None):
+    """Mean intensity of each frame (within the mask)
+    """
+    return np.mean(frames_by_pixels(data, mask), axis=1)
+
+
+def dvars(data, mask=None):
+    """Root mean square intensity change of each frame from the previous frame
+    (0 for the first frame)
+    """
+    diffs = np.diff(frames_by_pixels(data, mask).astype(float), axis=0)
+    return np.concatenate([[0], np.sqrt(np.mean(diffs ** 2, axis=1))])
+
+
+def temporal_snr(data):
+    """Temporal mean divided by temporal standard deviation of each pixel
+    (0 where the standard deviation is 0)
+    """
+    data = np.asarray(data, dtype=float)
+    mean = np.mean(data, axis=-1)
+    std = np.std(data, axis=-1)
+    tsnr = np.zeros(mean.shape)
+    tsnr[std > 0] = mean[std > 0] / std[std > 0]
+    return tsnr
+
+
+def read_motion_parameters(moco_file):
+    """Read the motion parameters that FSL's mcflirt -plots saved with moco_file
+    Returns a (frames, 6) array (3 rotations in radians, 3 translations),
+    or None if no parameter file is found.
+    """
+    stem = moco_file
+    for ext in ['.nii.gz', '.nii']:
+        if stem.endswith(ext):
+            stem = stem[:-len(ext)]
+    for par_file in [stem + '.par', moco_file + '.par']:
+        if os.path.exists(par_file):
+            return np.atleast_2d(np.loadtxt(par_file))
+    return None
+
+
+def framewise_displacement(motion_parameters, radius=50.):
+    """Framewise displacement from (frames, 6) mcflirt motion parameters
+    radius = radius used to convert rotations (radians) to displacements
+    (0 for the first frame)
+    """
+    diffs = np.abs(np.diff(motion_parameters, axis=0))
+    fd = radius * np.sum(diffs[:, :3], axis=1) + np.sum(diffs[:, 3:], axis=1)
+    return np.concatenate([[0], fd])
+
+
+def summarize_runs(test, measures, tsnr, frames_per_run, n_pixels,
+                   max_mean_fd, max_bad_pixel_fraction):
+    """Summarize per-frame measures for each run and flag bad runs
+    measures = dictionary of per-frame arrays ('fd', 'dvars',
+               'zero_pixels', 'saturated_pixels')
+    tsnr = list of tSNR maps, one per run
+    n_pixels = number of pixels per frame
+    Returns a list of rows (dictionaries with keys from summary_columns);
+    'missing' lists the measures ('fd', 'pixels') that are not available.
+    """
+    rows = []
+    for irun in range(len(tsnr)):
+        run = slice(irun * frames_per_run, (irun + 1) * frames_per_run)
+        row = {'test': test, 'run': irun + 1, 'frames': frames_per_run,
+               'mean_fd': np.mean(measures['fd'][run]),
+               'max_fd': np.max(measures['fd'][run]),
+               'mean_dvars': np.mean(measures['dvars'][run]),
+               'median_tsnr': np.median(tsnr[irun][tsnr[irun] > 0])
+                              if np.any(tsnr[irun] > 0) else 0,
+               'zero_pixels': np.sum(measures['zero_pixels'][run]),
+               'saturated_pixels': np.sum(measures['saturated_pixels'][run])}
+        bad_pixel_fraction = (row['zero_pixels'] + row['saturated_pixels']) / \
+                             float(frames_per_run * n_pixels)
+        missing = []
+        if np.any(np.isnan(measures['fd'][run])):
+            missing.append('fd')
+        if np.isnan(bad_pixel_fraction):
+            missing.append('pixels')
+        row['missing'] = ','.join(missing)
+        row['flagged'] = int(bool(missing) or row['mean_fd'] > max_mean_fd or
+                             bad_pixel_fraction > max_bad_pixel_fraction)
+        rows.append(row)
+    return rows
+
+
+def write_summary(rows, summary_file):
+    """Write summary rows to a tab-delimited table
+    """
+    with open(summary_file, 'w') as f:
+        csv_writer = csv.writer(f, dialect=csv.excel_tab)
+        csv_writer.writerow(summary_columns)
+        for row in rows:
+            csv_writer.writerow(['{0:.4g}'.format(row[x])
+                                 if isinstance(row[x], float) else row[x]
+                                 for x in summary_columns])
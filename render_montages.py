@@ -0,0 +1,114 @@
+#!/usr/bin/python
+"""
+Render montages of preprocessed bee brain images straight from memory.
+
+(1) Take image volumes (x, y, frames) that are already in memory,
+    such as the raw ratio, affine, nonlinear, and smoothed stacks.
+(2) Rescale each frame of each volume to the range [0,255]
+    (vectorized over a range of frames at a time).
+(3) Tile the frames side by side with a black border and a frame label
+    (like ImageMagick's "montage -geometry +1+0 -tile 4x -background black").
+(4) Write a .png file per montage and an animated .gif of all montages,
+    in one pass, rendering ranges of frames in parallel.
+
+This replaces the chain of ConvertToJpg, convert, and montage calls
+(about 11 processes and several disk round-trips per frame).
+
+Example:
+    from render_montages import save_montages
+    save_montages([B, Bc_affine, Bc, Bc_smooth], 'output/images',
+                  'output/montages.gif')
+
+Requirements:
+* Python libraries:  numpy, Pillow
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image, ImageDraw
+
+gap = 1  # black border (pixels) to the left and right of each tile
+label_height = 12  # height (pixels) of the frame label below the tiles
+frames_per_chunk = 32  # number of frames rendered by each job
+frame_duration = 100  # milliseconds per frame of the animated .gif
+
+
+def normalize_frames(volume):
+    """Rescale each frame of an (x, y, frames) volume to uint8 [0,255]
+    Non-finite values (such as from zero denominators) are set to 0.
+    Returns a (frames, y, x) array, oriented for display.
+    """
+    volume = np.asarray(volume, dtype=float)
+    finite = np.isfinite(volume)
+    lo = np.min(np.where(finite, volume, np.inf), axis=(0, 1))
+    hi = np.max(np.where(finite, volume, -np.inf), axis=(0, 1))
+    span = hi - lo
+    span[~(span > 0)] = np.inf  # constant or empty frames map to 0
+    lo[~np.isfinite(lo)] = 0
+    with np.errstate(invalid='ignore'):
+        scaled = 255 * (volume - lo) / span
+    scaled[~finite] = 0
+    return np.transpose(scaled, (2, 1, 0)).round().astype(np.uint8)
+
+
+def render_montages(volumes, start, stop):
+    """Render montages of frames [start, stop) of a list of volumes
+    volumes = list of (x, y, frames) arrays, one tile per volume
+    Returns a (frames, height, width) uint8 array.
+    """
+    nframes = stop - start
+    xdim, ydim = np.shape(volumes[0])[:2]
+    tile_width = xdim + 2 * gap
+    montages = np.zeros((nframes, ydim + label_height,
+                         len(volumes) * tile_width), dtype=np.uint8)
+    for itile, volume in enumerate(volumes):
+        left = itile * tile_width + gap
+        montages[:, :ydim, left:left + xdim] = \
+            normalize_frames(volume[:, :, start:stop])
+
+    # Label each montage with its (1-based) frame number
+    for iframe in range(nframes):
+        image = Image.fromarray(montages[iframe])
+        ImageDraw.Draw(image).text((gap + 1, ydim), str(start + iframe + 1),
+                                   fill=255)
+        montages[iframe] = np.asarray(image)
+    return montages
+
+
+def save_montages(volumes, output_dir=None, output_movie=None, n_jobs=0):
+    """Save a montage .png per frame and/or an animated .gif of all frames
+    volumes = list of (x, y, frames) arrays, one tile per volume
+    output_dir = directory for montage<frame>.png files (None to skip)
+    output_movie = animated .gif file name (None to skip)
+    n_jobs = maximum number of frame ranges rendered at once (0 = number of CPUs)
+    """
+    nframes = np.shape(volumes[0])[2]
+    chunks = [(x, min(x + frames_per_chunk, nframes))
+              for x in range(0, nframes, frames_per_chunk)]
+    if not chunks:
+        return
+    if not n_jobs or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+
+    def render_chunk(chunk):
+        montages = render_montages(volumes, chunk[0], chunk[1])
+        if output_dir:
+            for iframe, montage in enumerate(montages):
+                Image.fromarray(montage).save(os.path.join(output_dir,
+                    'montage' + str(chunk[0] + iframe + 1) + '.png'))
+        return montages
+
+    with ThreadPoolExecutor(max_workers=min(n_jobs, len(chunks))) as pool:
+        # Chunks come back in frame order, so the movie streams from them
+        rendered = pool.map(render_chunk, chunks)
+        if output_movie:
+            frames = (Image.fromarray(montage)
+                      for montages in rendered for montage in montages)
+            first = next(frames)
+            first.save(output_movie, save_all=True, append_images=frames,
+                       duration=frame_duration, loop=0)
+        else:
+            # Wait for every chunk (and raise any error from rendering)
+            for montages in rendered:
+                pass
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+"""
+Run external tools (FSL, ANTS, ImageMagick) as pooled subprocess jobs.
+
+(1) Each command is given as an argument list and run without a shell,
+    so file names never need quoting.
+(2) Independent commands run concurrently, with at most n_jobs at a time.
+(3) Each job records its exit status, run time, and captured output,
+    so failures are reported instead of silently ignored.
+(4) Each job's own multithreading (ITK in ANTS, OpenMP in FSL) is limited
+    so that n_jobs jobs together use about one thread per CPU.
+(5) Intermediate files can be kept in a work directory on tmpfs
+    (/dev/shm when it has room) rather than on the shared filesystem.
+
+Tools are looked up on the PATH.  Setting the BEEBRAINS_TOOL_DIR environment
+variable (or passing tool_dir) puts a directory in front of the PATH, so stub
+executables can stand in for the real tools when testing.
+
+Example:
+    from run_tools import run_commands, report_failures
+    cmds = [['fslmaths', in_file, '-s', '3', out_file] for ...]
+    results = run_commands(cmds, n_jobs=4)
+    report_failures(results)
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+tmpfs_dirs = ['/dev/shm', '/run/shm']  # candidate in-memory filesystems
+tool_dir_variable = 'BEEBRAINS_TOOL_DIR'  # directory searched before the PATH
+work_dir_variable = 'BEEBRAINS_WORK_DIR'  # directory for work directories
+thread_variables = ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'OMP_NUM_THREADS']
+
+CommandResult = namedtuple('CommandResult',
+                           ['cmd', 'returncode', 'seconds', 'stdout', 'stderr'])
+
+
+def tool_environment(tool_dir=None, threads_per_job=None):
+    """Return an environment whose PATH starts with tool_dir (if any)
+    tool_dir = directory of executables to use before those on the PATH
+               (defaults to the BEEBRAINS_TOOL_DIR environment variable)
+    threads_per_job = number of threads each tool may use (None = no limit);
+                      thread settings already in the environment are kept
+    """
+    env = os.environ.copy()
+    if tool_dir is None:
+        tool_dir = env.get(tool_dir_variable)
+    if tool_dir:
+        env['PATH'] = os.pathsep.join([tool_dir, env.get('PATH', '')])
+    if threads_per_job:
+        for variable in thread_variables:
+            env.setdefault(variable, str(threads_per_job))
+    return env
+
+
+def run_command(cmd, env=None, cwd=None, verbose=True):
+    """Run one command (argument list, no shell) and return a CommandResult
+    """
+    cmd = [str(x) for x in cmd]
+    if env is None:
+        env = tool_environment()
+    if verbose:
+        print(' '.join(cmd))
+    start = time.time()
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, env=env, cwd=cwd,
+                                universal_newlines=True)
+        stdout, stderr = proc.communicate()
+        returncode = proc.returncode
+    except OSError as error:
+        # The executable is missing or not runnable
+        stdout, stderr = '', str(error)
+        returncode = 127
+    return CommandResult(cmd, returncode, time.time() - start, stdout, stderr)
+
+
+def run_commands(cmds, n_jobs=0, tool_dir=None, cwd=None, verbose=True,
+                 threads_per_job=None):
+    """Run independent commands concurrently and return their CommandResults
+    cmds = list of argument lists
+    n_jobs = maximum number of commands running at once (0 = number of CPUs)
+    threads_per_job = number of threads each command may use
+                      (None = number of CPUs divided by n_jobs)
+    Results are returned in the same order as cmds.
+    """
+    cmds = list(cmds)
+    if not cmds:
+        return []
+    n_cpus = os.cpu_count() or 1
+    if not n_jobs or n_jobs < 1:
+        n_jobs = n_cpus
+    n_jobs = min(n_jobs, len(cmds))
+    if threads_per_job is None and n_jobs > 1:
+        threads_per_job = max(1, n_cpus // n_jobs)
+    env = tool_environment(tool_dir, threads_per_job)
+    if n_jobs == 1 or len(cmds) == 1:
+        return [run_command(cmd, env, cwd, verbose) for cmd in cmds]
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        return list(pool.map(lambda cmd: run_command(cmd, env, cwd, verbose),
+                             cmds))
+
+
+def report_failures(results):
+    """Print each failed command with its exit status and error output
+    Returns the list of failed CommandResults.
+    """
+    failed = [x for x in results if x.returncode != 0]
+    for result in failed:
+        print('  Command failed (exit status ' + str(result.returncode) +
+              '): ' + ' '.join(result.cmd))
+        if result.stderr.strip():
+            print('    ' + result.stderr.strip().replace('\n', '\n    '))
+    if results:
+        print('  {0} of {1} commands succeeded in {2:.1f} s total job time'.
+              format(len(results) - len(failed), len(results),
+                     sum(x.seconds for x in results)))
+    return failed
+
+
+def make_work_dir(prefix='beebrains_', nbytes=0, work_root=None):
+    """Make a temporary work directory
+    nbytes = estimated size of the files to be kept there
+    work_root = directory to make it in (defaults to the BEEBRAINS_WORK_DIR
+                environment variable, else tmpfs if it has room for nbytes,
+                else the system temporary directory)
+    """
+    if work_root is None:
+        work_root = os.environ.get(work_dir_variable)
+    if work_root:
+        return tempfile.mkdtemp(prefix=prefix, dir=work_root)
+    for tmpfs_dir in tmpfs_dirs:
+        if os.path.isdir(tmpfs_dir) and os.access(tmpfs_dir, os.W_OK) and \
+           shutil.disk_usage(tmpfs_dir).free > nbytes:
+            return tempfile.mkdtemp(prefix=prefix, dir=tmpfs_dir)
+    return tempfile.mkdtemp(prefix=prefix)
+
+
+def remove_work_dir(work_dir):
+    """Remove a work directory made by make_work_dir
+    """
+    shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from frame_store import FrameStore
+
+
+def test_round_trip(tmp_path):
+    filename = str(tmp_path / 'bee_images.frames')
+    with FrameStore(filename, 'w') as store:
+        for i in range(5):
+            store.append('image' + str(i + 1), np.full((3, 4), i, dtype=float))
+        # Frames can be read back before the store is closed
+        assert store['image3'][0, 0] == 2
+    with FrameStore(filename) as store:
+        assert len(store) == 5
+        assert 'image5' in store and 'image6' not in store
+        assert store['image5'].shape == (3, 4)
+        assert np.all(store['image5'] == 4)
+
+
+def test_append_and_replace(tmp_path):
+    filename = str(tmp_path / 'bee_images.frames')
+    with FrameStore(filename, 'w') as store:
+        store.append('image1', np.zeros((3, 4)))
+    with FrameStore(filename, 'a') as store:
+        store.append('image1_motioncorrected', np.ones((3, 4), dtype='<i2'))
+        store.append('image1', np.full((2, 2), 7.))
+    with FrameStore(filename) as store:
+        assert len(store) == 2
+        assert store['image1_motioncorrected'].dtype == np.dtype('<i2')
+        assert np.all(store['image1'] == 7)
+
+
+def test_interrupted_append_keeps_earlier_frames(tmp_path):
+    filename = str(tmp_path / 'bee_images.frames')
+    with FrameStore(filename, 'w') as store:
+        store.append('image1', np.arange(12.).reshape(3, 4))
+    # Append without flushing or closing, as if the session were interrupted
+    store = FrameStore(filename, 'a')
+    store.append('image1_motioncorrected', np.ones((300, 400)))
+    store.file.flush()
+    with FrameStore(filename) as store_read:
+        assert list(store_read.names) == ['image1']
+        assert store_read['image1'][2, 3] == 11
+    store.close()
+    with FrameStore(filename) as store_read:
+        assert len(store_read) == 2
+
+
+def test_corrupt_file(tmp_path):
+    filename = str(tmp_path / 'bee_images.frames')
+    with open(filename, 'wb') as f:
+        f.write(b'not a frame store')
+    with pytest.raises(IOError):
+        FrameStore(filename)
+    with FrameStore(filename, 'w') as store:
+        store.append('image1', np.zeros((3, 4)))
+    with open(filename, 'r+b') as f:
+        f.seek(-4, 2)
+        f.write(b'\xff\xfe{[')
+    with pytest.raises(IOError):
+        FrameStore(filename)
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from pst_format import open_pst, check_geometry
+
+
+def smooth_stack(xdim, ydim, n_frames):
+    """Stack of smooth images (like camera frames) with a little noise
+    """
+    y, x = np.meshgrid(np.linspace(0, 6, ydim), np.linspace(0, 6, xdim))
+    image = 1000 + 500 * np.sin(x) * np.cos(y)
+    noise = np.random.RandomState(0).randint(0, 20, (n_frames, xdim, ydim))
+    return image + noise
+
+
+def test_usual_run_length_chooses_geometry(tmp_path):
+    # A flat field fits every known geometry; only 130 x 172 gives 232 frames
+    filename = str(tmp_path / 'flat.pst')
+    stack = np.random.RandomState(0).poisson(1000, (232, 130, 172))
+    stack.astype('<i2').tofile(filename)
+    pst = open_pst(filename)
+    assert (pst.xdim, pst.ydim, pst.n_frames) == (130, 172, 232)
+    assert np.all(pst.frames[-1] == stack[-1])
+
+
+def test_ambiguous_geometry_raises(tmp_path):
+    # Shot noise on an unbinned stack whose 20 frames also fit 130 x 172 x 80
+    filename = str(tmp_path / 'noisy.pst')
+    stack = np.random.RandomState(0).poisson(smooth_stack(260, 344, 20) / 10.)
+    stack.astype('<i2').tofile(filename)
+    with pytest.raises(ValueError):
+        open_pst(filename)
+    pst = open_pst(filename, n_frames=20)
+    assert (pst.xdim, pst.ydim) == (260, 344)
+    pst = open_pst(filename, xdim=260, ydim=344)
+    assert pst.n_frames == 20
+    assert np.all(pst.frames == stack)
+
+
+def test_unbinned_big_endian(tmp_path):
+    filename = str(tmp_path / 'unbinned.pst')
+    stack = smooth_stack(260, 344, 10).astype('>i2')
+    stack.tofile(filename)
+    pst = open_pst(filename, xdim=260, ydim=344)
+    assert (pst.xdim, pst.ydim, pst.n_frames) == (260, 344, 10)
+    assert pst.dtype == np.dtype('>i2')
+    assert np.all(pst.frames == stack)
+
+
+def test_expected_frames_and_dimensions(tmp_path):
+    filename = str(tmp_path / 'binned.pst')
+    np.zeros((232, 130, 172), dtype='<i2').tofile(filename)
+    pst = open_pst(filename, n_frames=58)
+    assert (pst.xdim, pst.ydim) == (260, 344)
+    pst = open_pst(filename, xdim=130, ydim=172)
+    assert pst.n_frames == 232
+    with pytest.raises(ValueError):
+        open_pst(filename, n_frames=7)
+
+
+def test_bad_size_and_geometry_mismatch(tmp_path):
+    filename = str(tmp_path / 'odd.pst')
+    np.zeros(1001, dtype='<i2').tofile(filename)
+    with pytest.raises(ValueError):
+        open_pst(filename)
+    filename1 = str(tmp_path / 'run1.pst')
+    filename2 = str(tmp_path / 'run2.pst')
+    np.zeros((232, 130, 172), dtype='<i2').tofile(filename1)
+    np.zeros((200, 130, 172), dtype='<i2').tofile(filename2)
+    pst_files = [open_pst(filename1, 130, 172), open_pst(filename2, 130, 172)]
+    with pytest.raises(ValueError):
+        check_geometry(pst_files)
+    assert check_geometry(pst_files, n_frames=False) == (130, 172, None)
@@ -0,0 +1,47 @@
+import numpy as np
+
+from quality_control import count_bad_pixels, dvars, framewise_displacement, \
+    summarize_runs
+
+
+def test_count_bad_pixels_per_frame():
+    stack = np.ones((3, 4, 5), dtype='<i2')
+    stack[0, 0, :2] = 0
+    stack[2, 1, 1] = 4095
+    zero, saturated = count_bad_pixels(stack, 4095)
+    assert list(zero) == [2, 0, 0]
+    assert list(saturated) == [0, 0, 1]
+    assert count_bad_pixels(stack[0], 4095) == (2, 0)
+
+
+def test_dvars_and_framewise_displacement():
+    data = np.zeros((2, 2, 3))
+    data[..., 1] = 2
+    assert list(dvars(data)) == [0, 2, 2]
+    motion = np.zeros((3, 6))
+    motion[1, 0] = 0.01
+    motion[2, 3] = 0.5
+    assert np.allclose(framewise_displacement(motion), [0, 0.5, 1.0])
+
+
+def test_summarize_runs_flags_bad_pixels():
+    measures = {'fd': np.zeros(4), 'dvars': np.zeros(4),
+                'zero_pixels': np.array([0, 0, 1, 1]),
+                'saturated_pixels': np.zeros(4)}
+    tsnr = [np.ones((2, 2)), np.ones((2, 2))]
+    rows = summarize_runs(1, measures, tsnr, 2, 100, 0.5, 0.01)
+    assert [x['zero_pixels'] for x in rows] == [0, 2]
+    assert [x['flagged'] for x in rows] == [0, 0]
+    assert [x['missing'] for x in rows] == ['', '']
+    rows = summarize_runs(1, measures, tsnr, 2, 100, 0.5, 0.005)
+    assert [x['flagged'] for x in rows] == [0, 1]
+
+
+def test_summarize_runs_flags_missing_measures():
+    measures = {'fd': np.array([0, 0, np.nan, np.nan]), 'dvars': np.zeros(4),
+                'zero_pixels': np.array([np.nan, np.nan, 0, 0]),
+                'saturated_pixels': np.zeros(4)}
+    tsnr = [np.ones((2, 2)), np.ones((2, 2))]
+    rows = summarize_runs(1, measures, tsnr, 2, 100, 0.5, 0.01)
+    assert [x['missing'] for x in rows] == ['pixels', 'fd']
+    assert [x['flagged'] for x in rows] == [1, 1]
@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('PIL')
+from PIL import Image
+
+import render_montages
+from render_montages import normalize_frames, save_montages
+
+
+def test_normalize_frames():
+    volume = np.zeros((3, 2, 2))
+    volume[:, :, 0] = [[0, 1], [2, 3], [4, np.nan]]
+    volume[0, 0, 1] = np.inf
+    volume[1, 0, 1] = -np.inf
+    frames = normalize_frames(volume)
+    assert frames.shape == (2, 2, 3)
+    assert frames.dtype == np.uint8
+    # Each frame is rescaled to [0,255]; non-finite values are set to 0
+    assert frames[0].T.tolist() == [[0, 64], [128, 191], [255, 0]]
+    assert not np.any(frames[1])
+
+
+def test_save_montages(tmp_path, monkeypatch):
+    monkeypatch.setattr(render_montages, 'frames_per_chunk', 4)
+    xdim, ydim, nframes = 10, 8, 10
+    volumes = [np.random.RandomState(x).rand(xdim, ydim, nframes)
+               for x in range(3)]
+    movie = str(tmp_path / 'montages.gif')
+    save_montages(volumes, str(tmp_path), movie, n_jobs=2)
+
+    pngs = sorted(x for x in os.listdir(str(tmp_path)) if x.endswith('.png'))
+    assert pngs == sorted('montage{0}.png'.format(x + 1)
+                          for x in range(nframes))
+    width = 3 * (xdim + 2 * render_montages.gap)
+    height = ydim + render_montages.label_height
+    for png in pngs:
+        assert Image.open(str(tmp_path / png)).size == (width, height)
+    gif = Image.open(movie)
+    assert gif.size == (width, height)
+    assert gif.n_frames == nframes
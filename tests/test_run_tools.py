@@ -0,0 +1,97 @@
+import os
+import stat
+import time
+
+import run_tools
+from run_tools import run_commands, report_failures, make_work_dir, \
+    remove_work_dir
+
+
+def write_stub(tool_dir, name, script):
+    """Write an executable shell script standing in for an external tool
+    """
+    path = os.path.join(str(tool_dir), name)
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\n' + script + '\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def test_stub_tools_run_without_shell(tmp_path):
+    write_stub(tmp_path, 'fslmaths', 'printf "%s|" "$@"')
+    results = run_commands([['fslmaths', 'a b.nii.gz', '-s', 3]],
+                           tool_dir=str(tmp_path), verbose=False)
+    assert results[0].returncode == 0
+    # Arguments are passed as a list, so spaces are not split by a shell
+    assert results[0].stdout == 'a b.nii.gz|-s|3|'
+
+
+def test_exit_status_and_missing_tools(tmp_path):
+    write_stub(tmp_path, 'mcflirt', 'echo bad >&2; exit 3')
+    results = run_commands([['mcflirt'], ['no_such_tool_here']],
+                           tool_dir=str(tmp_path), verbose=False)
+    assert [x.returncode for x in results] == [3, 127]
+    assert results[0].stderr == 'bad\n'
+    assert report_failures(results) == results
+
+
+def test_commands_run_concurrently_in_order(tmp_path):
+    write_stub(tmp_path, 'ANTS', 'sleep 0.5; echo "$1"')
+    start = time.time()
+    results = run_commands([['ANTS', str(x)] for x in range(4)], n_jobs=4,
+                           tool_dir=str(tmp_path), verbose=False)
+    assert time.time() - start < 1.5
+    assert [x.stdout for x in results] == ['0\n', '1\n', '2\n', '3\n']
+    assert all(x.seconds >= 0.5 for x in results)
+
+
+def test_tool_dir_from_environment(tmp_path, monkeypatch):
+    write_stub(tmp_path, 'convert', 'echo stub')
+    monkeypatch.setenv(run_tools.tool_dir_variable, str(tmp_path))
+    assert run_commands([['convert']], verbose=False)[0].stdout == 'stub\n'
+
+
+def test_work_dir():
+    work_dir = make_work_dir()
+    assert os.path.isdir(work_dir)
+    remove_work_dir(work_dir)
+    assert not os.path.exists(work_dir)
+
+
+def test_threads_per_job(tmp_path, monkeypatch):
+    write_stub(tmp_path, 'ANTS',
+               'echo "$ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS $OMP_NUM_THREADS"')
+    for variable in run_tools.thread_variables:
+        monkeypatch.delenv(variable, raising=False)
+    monkeypatch.setattr(os, 'cpu_count', lambda: 8)
+    # Eight jobs at once on eight CPUs:  one thread each
+    results = run_commands([['ANTS']] * 8, n_jobs=0, tool_dir=str(tmp_path),
+                           verbose=False)
+    assert set(x.stdout for x in results) == set(['1 1\n'])
+    results = run_commands([['ANTS']] * 8, n_jobs=2, tool_dir=str(tmp_path),
+                           verbose=False)
+    assert set(x.stdout for x in results) == set(['4 4\n'])
+    # Settings already in the environment are kept
+    monkeypatch.setenv('OMP_NUM_THREADS', '3')
+    results = run_commands([['ANTS']] * 2, n_jobs=2, threads_per_job=2,
+                           tool_dir=str(tmp_path), verbose=False)
+    assert set(x.stdout for x in results) == set(['2 3\n'])
+
+
+def test_work_dir_location(tmp_path, monkeypatch):
+    work_dir = make_work_dir(work_root=str(tmp_path))
+    assert os.path.dirname(work_dir) == str(tmp_path)
+    remove_work_dir(work_dir)
+    monkeypatch.setenv(run_tools.work_dir_variable, str(tmp_path))
+    work_dir = make_work_dir()
+    assert os.path.dirname(work_dir) == str(tmp_path)
+    remove_work_dir(work_dir)
+    # Too little room on tmpfs:  use the system temporary directory
+    monkeypatch.delenv(run_tools.work_dir_variable)
+    monkeypatch.setattr(run_tools, 'tmpfs_dirs', [str(tmp_path)])
+    work_dir = make_work_dir(nbytes=2 ** 62)
+    assert os.path.dirname(work_dir) != str(tmp_path)
+    remove_work_dir(work_dir)
+    work_dir = make_work_dir(nbytes=1)
+    assert os.path.dirname(work_dir) == str(tmp_path)
+    remove_work_dir(work_dir)